@@ -1,53 +1,105 @@
+from LoopInvariants import find_invariant_ranges
 from Shared import TOKEN_TYPE
+from TailCalls import find_locals_to_reset, find_tail_calls
+from VMWriter import VMCode
+
+# Largest power of two constant whose multiplication is inlined as repeated doubling in hot functions
+MAX_INLINED_MULTIPLIER = 8
+
+# Nested expressions are compiled by direct calls up to this depth, deeper ones through the
+# task list, see compile_expression
+MAX_EXPRESSION_DEPTH = 16
+
+# VM commands of the binary operators, '*' and '/' are calls to the OS
+BINARY_OPERATORS = {
+    "+": "add", "-": "sub", "*": "call Math.multiply", "/": "call Math.divide",
+    "&": "and", "|": "or", "<": "lt", ">": "gt", "=": "eq"
+}
+
+# Part of every subroutine cache key, change it whenever the generated code changes
+CACHE_VERSION = 5
 
 
 class CompilationEngine:
-    def __init__(self, tokenizer, vm_writer, symbol_table):
+    def __init__(self, tokenizer, vm_writer, symbol_table, profile=None, cache=None, xml_writer=None):
         self.tokenizer = tokenizer
         self.symbol_table = symbol_table
         self.vm_writer = vm_writer
+        # Optional execution profile guiding branch layout and optimization effort
+        self.profile = profile
+        # Optional SubroutineCache holding the code of previously compiled subroutines
+        self.cache = cache
+        # Optional XMLWriter receiving the parse tree
+        self.xml_writer = xml_writer
         self.level = 0
         self.class_name = None
         self.subroutine_name = None
         self.label_counter = 0
+        # Number of expressions currently compiled by direct calls
+        self.expression_depth = 0
 
     def compile_keyword(self):
         if self.tokenizer.token_type() != TOKEN_TYPE.KEYWORD:
-            raise ValueError("Parse Error: Expected Keyword Token")
+            raise self.parse_error("Expected Keyword Token")
         value = self.tokenizer.key_word()
+        if self.xml_writer:
+            self.xml_writer.write_token(self.tokenizer.current_token)
         self.tokenizer.advance()
         return value
 
     def compile_identifier(self):
         if self.tokenizer.token_type() != TOKEN_TYPE.IDENTIFIER:
-            raise ValueError("Parse Error: Expected Identifier Token")
+            raise self.parse_error("Expected Identifier Token")
         value = self.tokenizer.identifier()
+        if self.xml_writer:
+            self.xml_writer.write_token(self.tokenizer.current_token)
         self.tokenizer.advance()
         return value
 
     def compile_symbol(self):
         if self.tokenizer.token_type() != TOKEN_TYPE.SYMBOL:
-            raise ValueError("Parse Error: Expected Symbol Token")
+            raise self.parse_error("Expected Symbol Token")
         value = self.tokenizer.symbol()
+        if self.xml_writer:
+            self.xml_writer.write_token(self.tokenizer.current_token)
         self.tokenizer.advance()
         return value
 
     def compile_string_constant(self):
         if self.tokenizer.token_type() != TOKEN_TYPE.STRING_CONST:
-            raise ValueError("Parse Error: Expected String Constant Token")
+            raise self.parse_error("Expected String Constant Token")
         value = self.tokenizer.string_const()
+        if self.xml_writer:
+            self.xml_writer.write_token(self.tokenizer.current_token)
         self.tokenizer.advance()
         return value
 
     def compile_integer_constant(self):
         if self.tokenizer.token_type() != TOKEN_TYPE.INT_CONST:
-            raise ValueError("Parse Error: Expected Integer Constant Token")
+            raise self.parse_error("Expected Integer Constant Token")
         value = self.tokenizer.int_const()
+        if self.xml_writer:
+            self.xml_writer.write_token(self.tokenizer.current_token)
         self.tokenizer.advance()
         return value
 
+    def open_element(self, tag):
+        if self.xml_writer:
+            self.xml_writer.open_element(tag)
+
+    def close_element(self, tag):
+        if self.xml_writer:
+            self.xml_writer.close_element(tag)
+
+    def parse_error(self, message):
+        token = self.tokenizer.current_token
+        if token is None:
+            return ValueError(f"Parse Error: {message} at end of input")
+        return ValueError(f"Parse Error: {message} at line {self.tokenizer.line_of(token.offset)}")
+
     # Maps to grammar rule: 'class' className '{' classVarDec * subroutineDec * '}'
     def compile_class(self):
+        self.open_element("class")
         self.compile_keyword()  # 'class'
         self.class_name = self.compile_identifier()  # 'className
         self.compile_symbol()  # '{'
@@ -58,16 +110,80 @@ class CompilationEngine:
 
         # subroutineDec*
         while self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() in ['constructor', 'function', 'method']:
-            self.compile_subroutine_dec()
+            # The parse tree needs all tokens, so the cache cannot be used for it
+            if self.cache and not self.xml_writer:
+                self.compile_cached_subroutine_dec()
+            else:
+                self.compile_subroutine_dec()
 
         self.compile_symbol()  # '}'
+        self.close_element("class")
+
+    # Reuses the code of the subroutine from the cache if it was compiled before. Label numbers
+    # start over in every subroutine, so its code does not depend on the rest of the class.
+    def compile_cached_subroutine_dec(self):
+        tokens = self.read_subroutine_tokens()
+        key = self.subroutine_cache_key(tokens)
+        # Source offsets are cached relative to the start of the subroutine
+        start_offset = tokens[0].offset
+        code = self.cache.get(key, start_offset)
+        if code is not None:
+            self.vm_writer.write_code(code)
+            return
+
+        self.tokenizer.replay(tokens)
+        start = self.vm_writer.mark()
+        self.compile_subroutine_dec()
+        self.cache.put(key, self.vm_writer.code_since(start), start_offset)
+
+    # Reads the tokens of a subroutine declaration up to the '}' closing its body
+    def read_subroutine_tokens(self):
+        tokens = []
+        depth = 0
+        while True:
+            token = self.tokenizer.current_token
+            if token is None:
+                raise self.parse_error("Unexpected end of input in subroutine")
+            tokens.append(token)
+            self.tokenizer.advance()
+
+            if token.token_type == TOKEN_TYPE.SYMBOL and token.value == "{":
+                depth += 1
+            elif token.token_type == TOKEN_TYPE.SYMBOL and token.value == "}":
+                depth -= 1
+                if depth == 0:
+                    return tokens
+
+    # The code of a subroutine depends on its tokens, the class name and variables, and the
+    # profile data about the subroutine. The relative token positions are included so that the
+    # cached source offsets stay valid.
+    def subroutine_cache_key(self, tokens):
+        start_offset = tokens[0].offset
+        key_data = [
+            CACHE_VERSION,
+            self.class_name,
+            sorted(self.symbol_table.class_scope.items()),
+            [(token.token_type.value, token.value, token.offset - start_offset) for token in tokens],
+        ]
+        if self.profile and len(tokens) > 2:
+            function_name = f"{self.class_name}.{tokens[2].value}"
+            key_data.append(self.profile.is_hot(function_name))
+            key_data.append(sorted(
+                (name, count) for name, count in self.profile.counts.items()
+                if name == function_name or name.startswith(f"{function_name}$")))
+        # Only needed with a cache, and slow to import
+        import hashlib
+        return hashlib.sha256(repr(key_data).encode("utf-8")).hexdigest()
 
     # Maps to grammar rule: ('constructor' | 'function' | 'method') ('void' | type) subroutineName '(' parameterList ')' subroutineBody
 
     def compile_subroutine_dec(self):
+        self.open_element("subroutineDec")
         # ('constructor' | 'function' | 'method')
         subroutine_type = self.compile_keyword()
         self.symbol_table.start_subroutine()
+        # Labels only have to be unique within a function
+        self.label_counter = 0
 
         # ('void' | type)
         if self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD:
@@ -96,6 +212,7 @@ class CompilationEngine:
 
         self.subroutine_name = None
         self.vm_writer.write_empty_line()
+        self.close_element("subroutineDec")
 
     # Maps to to the grammer rule 'int' | 'char' | 'boolean' | className
 
@@ -107,6 +224,7 @@ class CompilationEngine:
 
     # Maps to grammar rule: ('static' | 'field) type varName (',' varName)* ';'
     def compile_class_var_dec(self):
+        self.open_element("classVarDec")
         kind = self.compile_keyword()  # ('static | 'field')
         # type
         type = self.compile_type()
@@ -123,9 +241,11 @@ class CompilationEngine:
             self.symbol_table.define(name, type, kind)
         # ";"
         self.compile_symbol()
+        self.close_element("classVarDec")
 
     # Maps to grammar rule: ( (type varName) (',' type varName)* )?
     def compile_parameter_list(self):
+        self.open_element("parameterList")
         if (self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() in ['int', 'char', 'boolean']) or self.tokenizer.token_type() == TOKEN_TYPE.IDENTIFIER:
             # type
             type = self.compile_type()
@@ -142,9 +262,11 @@ class CompilationEngine:
                 # varName
                 name = self.compile_identifier()
                 self.symbol_table.define(name, type, 'arg')
+        self.close_element("parameterList")
 
     # Maps to grammar rule: '{' varDec* statements '}'
     def compile_subroutine_body(self, subroutine_type):
+        self.open_element("subroutineBody")
         # '{'
         self.compile_symbol()
 
@@ -152,8 +274,10 @@ class CompilationEngine:
         while self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() == 'var':
             self.compile_var_dec()
 
+        function_mark = self.vm_writer.mark()
         self.vm_writer.write_function(
-            f"{self.class_name}.{self.subroutine_name}", self.symbol_table.var_count('var'))
+            self.function_name(), self.symbol_table.var_count('var'))
+        declared_var_count = self.symbol_table.var_count('var')
 
         if subroutine_type == "constructor":
             no_of_fields = self.symbol_table.var_count('field')
@@ -163,15 +287,54 @@ class CompilationEngine:
         elif subroutine_type == "method":
             self.vm_writer.write_push("argument", 0)
             self.vm_writer.write_pop("pointer", 0)
+        entry_mark = self.vm_writer.mark()
 
         # statements
         self.compile_statements()
 
+        # A constructor allocates a new object on every call, so its calls cannot be turned into jumps
+        if subroutine_type != "constructor":
+            self.eliminate_tail_calls(entry_mark, subroutine_type == "method")
+
+        # Loops may have added locals holding hoisted values
+        if self.symbol_table.var_count('var') != declared_var_count:
+            self.vm_writer.rewrite_function(
+                function_mark, self.function_name(), self.symbol_table.var_count('var'))
+
         # '}'
         self.compile_symbol()
+        self.close_element("subroutineBody")
+
+    # Replaces every self-recursive call directly followed by a return in the body emitted since
+    # entry_mark by assigning the arguments and jumping back to entry_mark
+    def eliminate_tail_calls(self, entry_mark, is_method):
+        body = self.vm_writer.code_since(entry_mark)
+        arg_count = self.symbol_table.var_count('arg')
+        tail_calls = find_tail_calls(body.lines, self.function_name(), arg_count, is_method)
+        if not tail_calls:
+            return
+
+        # The VM only zeroes locals on a real call
+        jump = [f"pop argument {index}\n" for index in reversed(range(arg_count))]
+        for index in find_locals_to_reset(body.lines):
+            jump.extend(["push constant 0\n", f"pop local {index}\n"])
+        jump.append("goto TAIL_CALL_ENTRY\n")
+
+        self.vm_writer.cut(entry_mark)
+        rewritten = VMCode(["label TAIL_CALL_ENTRY\n"], [body.offsets[0] if body.offsets else None])
+        position = 0
+        for call in tail_calls:
+            rewritten.lines.extend(body.lines[position:call] + jump)
+            rewritten.offsets.extend(body.offsets[position:call] + [body.offsets[call]] * len(jump))
+            # The return after the call is never reached
+            position = call + 2
+        rewritten.lines.extend(body.lines[position:])
+        rewritten.offsets.extend(body.offsets[position:])
+        self.vm_writer.write_code(rewritten)
 
     # Maps to the grammar rule: 'var' type varName (',' varName)* ';'
     def compile_var_dec(self):
+        self.open_element("varDec")
         kind = self.compile_keyword()  # 'var'
         # type
         type = self.compile_type()
@@ -188,24 +351,30 @@ class CompilationEngine:
             self.symbol_table.define(name, type, kind)
         # ";"
         self.compile_symbol()
+        self.close_element("varDec")
 
     # Maps to the grammar rule: statement*
     def compile_statements(self):
+        self.open_element("statements")
         while self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() in ["let", "if", "while", "do", "return"]:
-            if self.tokenizer.key_word() == "let":
+            # One statement per pass, the next token may be the end of the input
+            statement = self.tokenizer.key_word()
+            if statement == "let":
                 self.compile_let_statement()
-            if self.tokenizer.key_word() == "if":
+            elif statement == "if":
                 self.compile_if_statement()
-            if self.tokenizer.key_word() == "while":
+            elif statement == "while":
                 self.compile_while_statement()
-            if self.tokenizer.key_word() == "do":
+            elif statement == "do":
                 self.compile_do_statement()
-            if self.tokenizer.key_word() == "return":
+            else:
                 self.compile_return_statement()
+        self.close_element("statements")
 
     # maps to grammar rule 'let' varName ('[' expression ']')? '=' expression';'
 
     def compile_let_statement(self):
+        self.open_element("letStatement")
         # 'let'
         self.compile_keyword()
         # varName
@@ -215,32 +384,26 @@ class CompilationEngine:
         is_array = False
         if self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == '[':
             is_array = True
-            # Push array base address
-            self.vm_writer.write_push(
-                self.symbol_table.virtual_segment_of(varName),
-                self.symbol_table.index_of(varName)
-            )
-
-            # '['
-            self.compile_symbol()
+            # Compute the address, but only decide how to use it once the value is known
+            address_start = self.vm_writer.mark()
+            array_index = self.start_array_index(varName)
             # expression (index)
             self.compile_expression()
-            # ']'
-            self.compile_symbol()
-
-            self.vm_writer.write_arithmetic("add")
+            address = self.finish_array_index(*array_index)
+            that_before_value = self.vm_writer.that_address
+            address_code = self.vm_writer.cut(address_start)
 
         # '='
         self.compile_symbol()
 
         # expression (value to assign)
+        value_start = self.vm_writer.mark()
         self.compile_expression()
 
         if is_array:
-            self.vm_writer.write_pop("temp", 0)
-            self.vm_writer.write_pop("pointer", 1)
-            self.vm_writer.write_push("temp", 0)
-            self.vm_writer.write_pop("that", 0)
+            value_code = self.vm_writer.cut(value_start)
+            self.compile_array_store(
+                address, address_code, value_code, that_before_value)
         else:
 
             self.vm_writer.write_pop(
@@ -250,15 +413,73 @@ class CompilationEngine:
 
         # ';'
         self.compile_symbol()
+        self.close_element("letStatement")
+
+    # Stores the value computed by value_code into the array element at address
+    def compile_array_store(self, address, address_code, value_code, that_before_value):
+        sets_that = "pop pointer 1\n" in value_code.lines
+        uses_that = sets_that or any(line.startswith(("push that", "pop that")) for line in value_code.lines)
+        has_call = any(line.startswith("call") for line in value_code.lines)
+
+        if address and address == that_before_value and not sets_that:
+            # THAT already points to the element and the value does not move it
+            self.vm_writer.write_code(value_code)
+        elif address and address == self.vm_writer.that_address and not has_call:
+            # Computing the value left THAT pointing to the element, as in let a[i] = a[i] + 1
+            self.vm_writer.write_code(value_code)
+        elif not uses_that:
+            # The value does not touch THAT, so it can be set before computing the value
+            self.vm_writer.write_code(address_code)
+            self.vm_writer.write_pop("pointer", 1)
+            self.vm_writer.write_code(value_code)
+            self.vm_writer.that_address = None if has_call else address
+        else:
+            self.vm_writer.write_code(address_code)
+            self.vm_writer.write_code(value_code)
+            self.vm_writer.write_pop("temp", 0)
+            self.vm_writer.write_pop("pointer", 1)
+            self.vm_writer.that_address = address
+            self.vm_writer.write_push("temp", 0)
+        self.vm_writer.write_pop("that", 0)
+
+    # Compiles '[' expression ']' following the array variable identifier and leaves the address
+    # of the element on the stack. The index expression is compiled in between
+    # start_array_index(), which returns the arguments for finish_array_index(), and
+    # finish_array_index(). That returns a description of the address that allows recognizing
+    # repeated accesses to the same element, or None if the index is not a constant or a variable.
+    def start_array_index(self, identifier):
+        base_segment = self.symbol_table.virtual_segment_of(identifier)
+        base_index = self.symbol_table.index_of(identifier)
+        self.vm_writer.write_push(base_segment, base_index)
+
+        # '['
+        self.compile_symbol()
+        return base_segment, base_index, self.vm_writer.mark()
+
+    def finish_array_index(self, base_segment, base_index, index_start):
+        index_code = self.vm_writer.lines[index_start:]
+        # ']'
+        self.compile_symbol()
+
+        self.vm_writer.write_arithmetic("add")
+
+        if len(index_code) != 1:
+            return None
+        command, segment, index = index_code[0].split()
+        if command != "push" or segment not in ["constant", "local", "argument", "static", "this"]:
+            return None
+        return (base_segment, base_index, segment, int(index))
 
     # maps to the grammar rule 'if' '(' expression ')' '{' statements '}' ('else' '{' statements '}')?
 
     def compile_if_statement(self):
         label_num = self.label_counter
         self.label_counter += 1
+        true_label = f"IF_TRUE{label_num}"
         false_label = f"IF_FALSE{label_num}"
         end_label = f"IF_END{label_num}"
 
+        self.open_element("ifStatement")
         # 'if'
         self.compile_keyword()
 
@@ -267,8 +488,6 @@ class CompilationEngine:
 
         # expression
         self.compile_expression()
-        self.vm_writer.write_arithmetic("not")
-        self.vm_writer.write_if_goto(false_label)
 
         # ')'
         self.compile_symbol()
@@ -277,24 +496,72 @@ class CompilationEngine:
         self.compile_symbol()
 
         # statements
+        that_after_condition = self.vm_writer.that_address
+        then_start = self.vm_writer.mark()
         self.compile_statements()
-        self.vm_writer.write_goto(end_label)
+        then_code = self.vm_writer.cut(then_start)
 
         # '}'
         self.compile_symbol()
 
-        self.vm_writer.write_label(false_label)
+        else_code = None
         if self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() in ['else']:
             # else
             self.compile_keyword()
             # '{'
             self.compile_symbol()
-            # statements
+            # statements, which are only reached from the condition
+            self.vm_writer.that_address = that_after_condition
+            else_start = self.vm_writer.mark()
             self.compile_statements()
+            else_code = self.vm_writer.cut(else_start)
             # '}'
             self.compile_symbol()
+        self.close_element("ifStatement")
+
+        if else_code is not None and self.prefers_else_branch(label_num):
+            # The else branch is hotter, let it fall through. The then branch must still only run
+            # when the condition is true (-1), so conditions that may have other values are
+            # compared first.
+            if not self.condition_is_boolean():
+                self.vm_writer.write_arithmetic("not")
+                self.vm_writer.write_push("constant", 0)
+                self.vm_writer.write_arithmetic("eq")
+            self.vm_writer.write_if_goto(true_label)
+            self.vm_writer.write_code(else_code)
+            self.vm_writer.write_goto(end_label)
+            self.vm_writer.write_label(true_label)
+            self.vm_writer.write_code(then_code)
+        else:
+            self.vm_writer.write_arithmetic("not")
+            self.vm_writer.write_if_goto(false_label)
+            self.vm_writer.write_code(then_code)
+            self.vm_writer.write_goto(end_label)
+            self.vm_writer.write_label(false_label)
+            if else_code is not None:
+                self.vm_writer.write_code(else_code)
         self.vm_writer.write_label(end_label)
 
+    # Returns whether the condition just emitted is certainly 0 or -1
+    def condition_is_boolean(self):
+        lines = self.vm_writer.lines
+        comparisons = ["eq\n", "lt\n", "gt\n"]
+        if lines[-1] in comparisons:
+            return True
+        return len(lines) > 1 and lines[-1] == "not\n" and lines[-2] in comparisons
+
+    def prefers_else_branch(self, label_num):
+        if not self.profile:
+            return False
+        counts = self.profile.branch_counts(self.function_name(), label_num)
+        if not counts:
+            return False
+        then_count, else_count = counts
+        return else_count > then_count
+
+    def function_name(self):
+        return f"{self.class_name}.{self.subroutine_name}"
+
     # maps to the grammar rule 'while' '(' expression ')' '{' statements '}'
     def compile_while_statement(self):
         label_num = self.label_counter
@@ -302,6 +569,7 @@ class CompilationEngine:
         start_label = f"WHILE_START{label_num}"
         end_label = f"WHILE_END{label_num}"
 
+        self.open_element("whileStatement")
         # 'while'
         self.compile_keyword()
 
@@ -309,8 +577,10 @@ class CompilationEngine:
         self.compile_symbol()
 
         # expression
+        loop_start = self.vm_writer.mark()
         self.vm_writer.write_label(start_label)
         self.compile_expression()
+        condition_end = self.vm_writer.mark() - loop_start
         self.vm_writer.write_arithmetic("not")
         self.vm_writer.write_if_goto(end_label)
         # ')'
@@ -326,22 +596,58 @@ class CompilationEngine:
         # "}"
         self.compile_symbol()
         self.vm_writer.write_label(end_label)
+        self.hoist_loop_invariants(loop_start, condition_end)
+        self.close_element("whileStatement")
+
+    # Computes the values that do not change in the loop emitted since loop_start once, before
+    # the loop, and keeps them in locals added to the subroutine
+    def hoist_loop_invariants(self, loop_start, condition_end):
+        loop = self.vm_writer.code_since(loop_start)
+        ranges = find_invariant_ranges(loop.lines, condition_end)
+        if not ranges:
+            return
+
+        self.vm_writer.cut(loop_start)
+        hoisted = VMCode([], [])
+        rewritten = VMCode([], [])
+        # The local holding each hoisted expression, so repeated ones are computed only once
+        locals_of = {}
+        position = 0
+        for start, end in ranges:
+            expression = tuple(loop.lines[start:end])
+            local = locals_of.get(expression)
+            if local is None:
+                local = self.symbol_table.var_count('var')
+                self.symbol_table.define(f"$invariant{local}", "int", "var")
+                locals_of[expression] = local
+                hoisted.lines.extend(loop.lines[start:end] + [f"pop local {local}\n"])
+                hoisted.offsets.extend(loop.offsets[start:end] + [loop.offsets[end - 1]])
+            rewritten.lines.extend(loop.lines[position:start] + [f"push local {local}\n"])
+            rewritten.offsets.extend(loop.offsets[position:start] + [loop.offsets[start]])
+            position = end
+        rewritten.lines.extend(loop.lines[position:])
+        rewritten.offsets.extend(loop.offsets[position:])
+        self.vm_writer.write_code(hoisted)
+        self.vm_writer.write_code(rewritten)
 
     # maps to the grammar rule: 'do' subroutineCall ';'
 
     def compile_do_statement(self):
+        self.open_element("doStatement")
         # 'do'
         self.compile_keyword()
 
-        # subroutineCall
-        self.compile_term()
+        # subroutineCall, which is not wrapped in a term
+        self.run_tasks(self.start_operand)
         self.vm_writer.write_pop("temp", 0)
 
         # ';'
         self.compile_symbol()
+        self.close_element("doStatement")
 
     # maps to the grammar rule: 'return' expression? ';'
     def compile_return_statement(self):
+        self.open_element("returnStatement")
         # 'return'
         self.compile_keyword()
 
@@ -355,41 +661,180 @@ class CompilationEngine:
         self.vm_writer.write_return()
         # ';'
         self.compile_symbol()
+        self.close_element("returnStatement")
 
     # maps to the grammar statement: term (op term)*
+    #
+    # Expressions nest arbitrarily deep, so they are not compiled by plain recursion: the methods
+    # below that take a task list compile as much as they can directly and push the remaining
+    # work as (method, arguments) tasks, which run_tasks() then executes last in, first out.
+    # Nesting is only followed by direct calls up to MAX_EXPRESSION_DEPTH, so the Python stack
+    # stays bounded no matter how deep the expression is.
     def compile_expression(self):
-        self.compile_term()
-
-        while self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() in ["+", "-", "*", "/", "&", "|", "<", ">", "="]:
+        self.run_tasks(self.start_expression)
+
+    def run_tasks(self, task):
+        tasks = [(task, ())]
+        while tasks:
+            task, args = tasks.pop()
+            task(tasks, *args)
+
+    # Compiles an expression as far as possible. Returns True if the expression is complete and
+    # False if tasks to finish it were pushed.
+    def start_expression(self, tasks):
+        if self.expression_depth == MAX_EXPRESSION_DEPTH:
+            tasks.append((self.start_expression, ()))
+            return False
+
+        self.open_element("expression")
+        self.expression_depth += 1
+        depth = len(tasks)
+        if self.start_term(tasks):
+            self.continue_expression(tasks)
+        else:
+            tasks.insert(depth, (self.continue_expression, ()))
+        self.expression_depth -= 1
+        return len(tasks) == depth
+
+    # Compiles the (op term)* part of an expression
+    def continue_expression(self, tasks):
+        tokenizer = self.tokenizer
+        while tokenizer.token_type() == TOKEN_TYPE.SYMBOL and tokenizer.symbol() in BINARY_OPERATORS:
             # op
             operator = self.compile_symbol()
+
+            if operator == "*" and self.is_inlinable_multiplier():
+                self.open_element("term")
+                multiplier = self.compile_integer_constant()
+                self.close_element("term")
+                self.compile_doubling(multiplier)
+                continue
+
             # term
-            self.compile_term()
-
-            if operator == "+":
-                self.vm_writer.write_arithmetic("add")
-            elif operator == "-":
-                self.vm_writer.write_arithmetic("sub")
-            elif operator == "*":
-                self.vm_writer.write_call("Math.multiply", 2)
-            elif operator == "/":
-                self.vm_writer.write_call("Math.divide", 2)
-            elif operator == "&":
-                self.vm_writer.write_arithmetic("and")
-            elif operator == "|":
-                self.vm_writer.write_arithmetic("or")
-            elif operator == "<":
-                self.vm_writer.write_arithmetic("lt")
-            elif operator == ">":
-                self.vm_writer.write_arithmetic("gt")
-            elif operator == "=":
-                self.vm_writer.write_arithmetic("eq")
+            depth = len(tasks)
+            if not self.start_term(tasks):
+                # Apply the operator and go on with the expression once the term is done
+                tasks[depth:depth] = [
+                    (self.continue_expression, ()), (self.compile_operator, (operator,))]
+                return
+            self.compile_operator(tasks, operator)
+        self.close_element("expression")
+
+    def compile_operator(self, tasks, operator):
+        if operator == "*":
+            self.vm_writer.write_call("Math.multiply", 2)
+        elif operator == "/":
+            self.vm_writer.write_call("Math.divide", 2)
+        else:
+            self.vm_writer.write_arithmetic(BINARY_OPERATORS[operator])
+
+    # Multiplying by a small power of two is cheaper as repeated doubling than as a call to
+    # Math.multiply, but the code is larger, so this is only done in hot functions
+    def is_inlinable_multiplier(self):
+        if not (self.profile and self.profile.is_hot(self.function_name())):
+            return False
+        if self.tokenizer.token_type() != TOKEN_TYPE.INT_CONST:
+            return False
+        value = self.tokenizer.int_const()
+        return 2 <= value <= MAX_INLINED_MULTIPLIER and value & (value - 1) == 0
+
+    def compile_doubling(self, multiplier):
+        while multiplier > 1:
+            self.vm_writer.write_pop("temp", 1)
+            self.vm_writer.write_push("temp", 1)
+            self.vm_writer.write_push("temp", 1)
+            self.vm_writer.write_arithmetic("add")
+            multiplier //= 2
+
+    # maps to the grammar rule: integerConstant | stringConstant | keywordConstant | varName |
+    # varName '[' expression ']' | subroutineCall | '(' expression ')' | unaryOp term
+    #
+    # Compiles a term as far as possible. Returns True if the term is complete and False if tasks
+    # to finish it were pushed.
+    def start_term(self, tasks):
+        if not (self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() in ["~", "-"]):
+            self.open_element("term")
+            depth = len(tasks)
+            if self.start_operand(tasks):
+                self.close_element("term")
+                return True
+            tasks.insert(depth, (self.finish_term, ()))
+            return False
+
+        # unaryOp*, every operator starts a term that contains the next one
+        unary_operators = []
+        while self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() in ["~", "-"]:
+            self.open_element("term")
+            value = self.compile_symbol()
+            unary_operators.append((self.compile_unary_operator, (value,)))
+
+        self.open_element("term")
+        depth = len(tasks)
+        if self.start_operand(tasks):
+            self.close_element("term")
+            for task, args in reversed(unary_operators):
+                task(tasks, *args)
+            return True
+        # The innermost operator has to be applied first, so it goes on top
+        tasks[depth:depth] = unary_operators + [(self.finish_term, ())]
+        return False
+
+    def finish_term(self, tasks):
+        self.close_element("term")
+
+    def compile_unary_operator(self, tasks, operator):
+        if operator == "~":
+            self.vm_writer.write_arithmetic("not")
+        else:
+            self.vm_writer.write_arithmetic("neg")
+        self.close_element("term")
+
+    # Compiles a term that does not start with a unary operator, see start_term
+    def start_operand(self, tasks):
+        token_type = self.tokenizer.token_type()
+        if token_type == TOKEN_TYPE.IDENTIFIER:
+            identifier = self.compile_identifier()
+            next_symbol = self.tokenizer.symbol() if self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL else None
+
+            # className or varname
+            if next_symbol == ".":
+                self.compile_symbol()
+                subroutine_name = self.compile_identifier()
+                self.compile_symbol()
+                if self.symbol_table.get(identifier):
+                    # method call
+                    self.vm_writer.write_push(self.symbol_table.virtual_segment_of(
+                        identifier), self.symbol_table.index_of(identifier))
+                    class_name = self.symbol_table.type_of(identifier)
+                    return self.start_call(tasks, f"{class_name}.{subroutine_name}", 1)
+                return self.start_call(tasks, f"{identifier}.{subroutine_name}", 0)
 
-    def compile_term(self):
-        if self.tokenizer.token_type() == TOKEN_TYPE.INT_CONST:
+            # Array access, like array[index]
+            elif next_symbol == "[":
+                address_start = self.vm_writer.mark()
+                array_index = self.start_array_index(identifier)
+                depth = len(tasks)
+                if not self.start_expression(tasks):
+                    tasks.insert(depth, (self.finish_array_read, (address_start, array_index)))
+                    return False
+                self.finish_array_read(tasks, address_start, array_index)
+
+            # Calls methods of the current object
+            elif next_symbol == "(":
+                self.compile_symbol()
+                subroutine_name = identifier
+                self.vm_writer.write_push("pointer", 0)
+                return self.start_call(tasks, f"{self.class_name}.{subroutine_name}", 1)
+            # varName
+            else:
+                self.vm_writer.write_push(self.symbol_table.virtual_segment_of(
+                    identifier), self.symbol_table.index_of(identifier))
+            return True
+
+        elif token_type == TOKEN_TYPE.INT_CONST:
             value = self.compile_integer_constant()
             self.vm_writer.write_push("constant", value)
-        elif self.tokenizer.token_type() == TOKEN_TYPE.STRING_CONST:
+        elif token_type == TOKEN_TYPE.STRING_CONST:
             value = self.compile_string_constant()
             length = len(value)
             self.vm_writer.write_push("constant", length)
@@ -398,7 +843,7 @@ class CompilationEngine:
                 self.vm_writer.write_push('constant', ord(char))
                 self.vm_writer.write_call('String.appendChar', 2)
 
-        elif self.tokenizer.token_type() == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() in ["true", "false", "null", "this"]:
+        elif token_type == TOKEN_TYPE.KEYWORD and self.tokenizer.key_word() in ["true", "false", "null", "this"]:
             value = self.compile_keyword()
             if value == "true":
                 self.vm_writer.write_push("constant", 1)
@@ -410,79 +855,56 @@ class CompilationEngine:
             if value == "this":
                 self.vm_writer.write_push("pointer", 0)
 
-        elif self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() in ["~", "-"]:
-            value = self.compile_symbol()
-            self.compile_term()
-            if value == "~":
-                self.vm_writer.write_arithmetic("not")
-            else:
-                self.vm_writer.write_arithmetic("neg")
-
-        elif self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == "(":
+        elif token_type == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == "(":
             self.compile_symbol()
-            self.compile_expression()
+            depth = len(tasks)
+            if not self.start_expression(tasks):
+                tasks.insert(depth, (self.finish_symbol, ()))  # ')'
+                return False
             self.compile_symbol()
 
-        else:  # TOKEN_TYPE.IDENTIFIER
-            identifier = self.compile_identifier()
-            # className or varname
-            if self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == ".":
-                self.compile_symbol()
-                subroutine_name = self.compile_identifier()
-                self.compile_symbol()
-                if self.symbol_table.get(identifier):
-                    # method call
-                    self.vm_writer.write_push(self.symbol_table.virtual_segment_of(
-                        identifier), self.symbol_table.index_of(identifier))
-                    nArgs = self.compile_expression_list()
-                    class_name = self.symbol_table.type_of(identifier)
-                    self.vm_writer.write_call(
-                        f"{class_name}.{subroutine_name}", nArgs + 1)
-                else:
-                    nArgs = self.compile_expression_list()
-                    self.vm_writer.write_call(
-                        f"{identifier}.{subroutine_name}", nArgs)
-                self.compile_symbol()
-
-            # Array access, like array[index]
-            elif self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == "[":
-                self.vm_writer.write_push(
-                    self.symbol_table.virtual_segment_of(identifier),
-                    self.symbol_table.index_of(identifier)
-                )
-
-                self.compile_symbol()
-                self.compile_expression()
-                self.compile_symbol()
+        else:
+            # Fails with a parse error
+            self.compile_identifier()
+        return True
 
-                self.vm_writer.write_arithmetic("add")
+    def finish_symbol(self, tasks):
+        self.compile_symbol()
 
-                # Set THAT to point to arr[index]
-                self.vm_writer.write_pop("pointer", 1)
-                self.vm_writer.write_push("that", 0)     # Push arr[index]
+    def finish_array_read(self, tasks, address_start, array_index):
+        address = self.finish_array_index(*array_index)
 
-            # Calls methods of the current object
-            elif self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == "(":
+        if address and address == self.vm_writer.that_address:
+            # THAT already points to arr[index]
+            self.vm_writer.cut(address_start)
+        else:
+            # Set THAT to point to arr[index]
+            self.vm_writer.write_pop("pointer", 1)
+            self.vm_writer.that_address = address
+        self.vm_writer.write_push("that", 0)     # Push arr[index]
+
+    # Compiles expressionList ')' of a call to name after the '(', where extra_args arguments
+    # were already pushed. Returns whether the call is complete, like start_term.
+    def start_call(self, tasks, name, extra_args):
+        self.open_element("expressionList")
+        return self.continue_call(tasks, name, [0], extra_args)
+
+    # Compiles the remaining arguments of a call, arg_count holds the number compiled so far
+    def continue_call(self, tasks, name, arg_count, extra_args):
+        # expressionList: (expression (',' expression)*)?
+        while not (self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == ")"):
+            if arg_count[0]:
+                # ','
                 self.compile_symbol()
-                subroutine_name = identifier
-                self.vm_writer.write_push("pointer", 0)
-                nArgs = self.compile_expression_list()
-                self.vm_writer.write_call(
-                    f"{self.class_name}.{subroutine_name}", nArgs + 1)
+            arg_count[0] += 1
 
-                self.compile_symbol()
-            # varName
-            else:
-                self.vm_writer.write_push(self.symbol_table.virtual_segment_of(
-                    identifier), self.symbol_table.index_of(identifier))
+            depth = len(tasks)
+            if not self.start_expression(tasks):
+                tasks.insert(depth, (self.continue_call, (name, arg_count, extra_args)))
+                return False
+        self.close_element("expressionList")
 
-    def compile_expression_list(self):
-        nArgs = 0
-        if not (self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == ")"):
-            self.compile_expression()
-            nArgs += 1
-            while self.tokenizer.token_type() == TOKEN_TYPE.SYMBOL and self.tokenizer.symbol() == ",":
-                self.compile_symbol()
-                self.compile_expression()
-                nArgs += 1
-        return nArgs
+        self.vm_writer.write_call(name, arg_count[0] + extra_args)
+        # ')'
+        self.compile_symbol()
+        return True
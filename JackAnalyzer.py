@@ -1,42 +1,170 @@
+import io
 import os
 import sys
 from pathlib import Path
-import CompilationEngine
 from JackTokenizer import JackTokenizer
 from CompilationEngine import CompilationEngine
 from SymbolTable import SymbolTable
 from VMWriter import VMWriter
 
+# Modules only needed by options, like argparse or XMLWriter for --xml, are imported when the
+# option is used, so that compiling a single file starts as fast as possible, see StartupReport
 
-def parse_file(input_path):
+
+def parse_file(input_path, profile=None, cache=None, source_map=False, xml=False):
+    with open(input_path, 'r', encoding="utf-8") as input_file:
+        return compile_source(input_path, input_file, profile, cache, source_map, xml)
+
+
+# Compiles the source read from input_file, which was loaded from input_path. If file_writer is
+# given, the output files are handed to it instead of being written directly.
+def compile_source(input_path, input_file, profile=None, cache=None, source_map=False, xml=False,
+                   file_writer=None):
     output_path = input_path.with_suffix(".vm")
     tokens = []
-    with open(input_path, 'r', encoding="utf-8") as input_file:
-        tokenizer = JackTokenizer(input_file)
+    token_writer = None
+    tree_writer = None
+    try:
+        if xml:
+            from XMLWriter import XMLWriter
+            # Both files are streamed while compiling: FooT.xml holds the tokens, Foo.xml the parse tree
+            token_writer = XMLWriter(input_path.with_name(f"{input_path.stem}T.xml"), indent="")
+            token_writer.open_element("tokens")
+            tree_writer = XMLWriter(input_path.with_suffix(".xml"))
+        tokenizer = JackTokenizer(input_file, token_writer)
         symbol_table = SymbolTable()
-        vm_writer = VMWriter(output_path)
+        vm_writer = VMWriter(
+            output_path, tokenizer, input_path.name if source_map else None, file_writer)
         compilation_engine = CompilationEngine(
-            tokenizer, vm_writer, symbol_table)
+            tokenizer, vm_writer, symbol_table, profile, cache, tree_writer)
         compilation_engine.compile_class()
         vm_writer.close()
+        if xml:
+            # Tokens after the class are not part of the parse tree, but still belong to the token stream
+            while tokenizer.has_more_tokens():
+                tokenizer.advance()
+            token_writer.close_element("tokens")
+    finally:
+        # Also after a parse error, so everything streamed up to it reaches the files
+        for writer in [token_writer, tree_writer]:
+            if writer is not None:
+                writer.close()
     return tokens
 
 
-def parse_directory(path):
-    for file_path in path.glob('*.jack'):
-        parse_file(file_path)
+def parse_directory(path, profile=None, cache=None, source_map=False, xml=False):
+    for file_path in sorted(path.glob('*.jack')):
+        parse_file(file_path, profile, cache, source_map, xml)
 
 
-def main():
-    if len(sys.argv) == 1:
-        path = Path(os.getcwd())
-    else:
-        path = Path(sys.argv[1])
+# Like parse_directory, but reading the sources and writing the output files happens on
+# background threads while compiling. Files are compiled in the same order, so errors are
+# reported as by parse_directory.
+def parse_directory_pipelined(path, profile=None, cache=None, source_map=False, xml=False,
+                              queue_depth=None):
+    from Pipeline import DEFAULT_QUEUE_DEPTH, OutputWriter, SourceReader
+    if queue_depth is None:
+        queue_depth = DEFAULT_QUEUE_DEPTH
+    if queue_depth < 1:
+        raise ValueError(f"Queue depth must be at least 1, not {queue_depth}")
+    reader = SourceReader(sorted(path.glob('*.jack')), queue_depth)
+    writer = OutputWriter(queue_depth)
+    try:
+        for file_path, text in reader:
+            compile_source(file_path, io.StringIO(text), profile, cache, source_map, xml, writer)
+    except BaseException:
+        reader.close()
+        # Outputs of the files compiled before the error are still written, but the error that
+        # stopped the compile is the one reported
+        try:
+            writer.close()
+        except Exception:
+            pass
+        raise
+    reader.close()
+    writer.close()
+
 
+def compile_program(path, profile=None, cache=None, source_map=False, xml=False, pipeline=False,
+                    queue_depth=None):
     if path.is_file():
-        parse_file(path)
+        parse_file(path, profile, cache, source_map, xml)
+    elif pipeline:
+        parse_directory_pipelined(path, profile, cache, source_map, xml, queue_depth)
     else:
-        parse_directory(path)
+        parse_directory(path, profile, cache, source_map, xml)
+
+
+def queue_depth(value):
+    import argparse
+    depth = int(value)
+    if depth < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {depth}")
+    return depth
+
+
+def parse_arguments(arguments):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compiles a .jack file or a directory of .jack files to VM code.")
+    parser.add_argument("path", nargs="?", default=os.getcwd(),
+                        help="a .jack file or a directory (default: the current directory)")
+    parser.add_argument("--profile-use", metavar="PROFILE",
+                        help="optimize using execution counts recorded from the compiled program")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="reuse the code of unchanged subroutines compiled before, stored in DIR")
+    parser.add_argument("--source-map", action="store_true",
+                        help="write a .vm.map file linking each VM line to its .jack line")
+    parser.add_argument("--xml", action="store_true",
+                        help="also write the tokens to FooT.xml and the parse tree to Foo.xml")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="read and write files on background threads while compiling a directory")
+    parser.add_argument("--queue-depth", metavar="N", type=queue_depth,
+                        help="files read ahead and waiting to be written with --pipeline (default: 4)")
+    parser.add_argument("--bundle", metavar="FILE",
+                        help="also link all compiled classes into FILE, starting with a function index")
+    parser.add_argument("--os", metavar="DIR",
+                        help="with --bundle, also link the precompiled OS classes in DIR")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="with --bundle, store the code of identical functions only once")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="run the compile with the other options in a new interpreter, report "
+                        "where its startup time goes and fail if the startup target is missed")
+    args = parser.parse_args(arguments)
+    if (args.os or args.dedupe) and not args.bundle:
+        parser.error("--os and --dedupe require --bundle")
+    return args
+
+
+def main():
+    arguments = sys.argv[1:]
+    # Most calls only name what to compile, which needs no argparse
+    if len(arguments) <= 1 and not any(argument.startswith("-") for argument in arguments):
+        compile_program(Path(arguments[0] if arguments else os.getcwd()))
+        return
+
+    args = parse_arguments(arguments)
+    if args.startup_report:
+        from StartupReport import write_startup_report
+        target_met = write_startup_report(
+            [argument for argument in arguments if argument != "--startup-report"])
+        sys.exit(0 if target_met else 1)
+
+    path = Path(args.path)
+    profile = None
+    if args.profile_use:
+        from Profile import load_profile
+        profile = load_profile(args.profile_use)
+    cache = None
+    if args.cache_dir:
+        from SubroutineCache import SubroutineCache
+        cache = SubroutineCache(args.cache_dir)
+
+    compile_program(path, profile, cache, args.source_map, args.xml, args.pipeline, args.queue_depth)
+
+    if args.bundle:
+        from Linker import link_program
+        link_program(path, Path(args.bundle), args.os, args.dedupe)
 
 
 if __name__ == "__main__":
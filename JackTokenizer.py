@@ -1,11 +1,29 @@
-import string
-from Shared import TOKEN_TYPE, jack_symbols, keyword_str_to_constant
+import re
+from bisect import bisect_right
+from collections import deque
+from Shared import TOKEN_TYPE, jack_keywords, jack_symbol_class
+
+_whitespace = " \t\n\r\x0b\x0c"
+_symbol_class = jack_symbol_class
+
+# White space and comments between tokens
+_skip_pattern = re.compile(rf"(?:[{_whitespace}]+|//[^\n]*|/\*.*?(?:\*/|\Z))*", re.DOTALL)
+
+# Identifiers and keywords run up to the next white space or symbol
+_token_pattern = re.compile(rf"""
+    (?P<symbol>[{_symbol_class}])
+  | (?P<int_const>\d+)
+  | "(?P<string_const>[^"]*)"?
+  | (?P<word>[^{_whitespace}{_symbol_class}]+)
+""", re.VERBOSE)
 
 
 class JackToken:
-    def __init__(self, token_type, value):
+    def __init__(self, token_type, value, offset=None):
         self.token_type = token_type
         self.value = value
+        # Position of the token's first character in the source text
+        self.offset = offset
         self.done = False
 
     def __str__(self):
@@ -18,16 +36,25 @@ class JackTokenizer:
     The token types are specified according to Jack grammar.
     """
 
-    def __init__(self, file):
+    def __init__(self, file, token_writer=None):
         """Initialize the tokenizer with an input file.
 
         Args:
             file (TextIOWrapper): The input file to tokenize.
+            token_writer (XMLWriter, optional): Receives every token as soon as it is read.
         """
-        self.file = file
+        self.token_writer = token_writer
+        self.text = file.read()
+        self.position = 0
+        # Offsets at which lines start, built on first use by line_of()
+        self.line_starts = None
         # Initially there is no current token
         self.current_token = None
         self.next_token = None
+        # Offset of the token that was current before the last advance()
+        self.previous_offset = None
+        # Tokens handed back with replay(), served before reading further input
+        self.replayed_tokens = deque()
         self.advance()
 
     # GENERAL
@@ -44,113 +71,74 @@ class JackTokenizer:
 
         This method should only be called if has_more_tokens() returns True.
         """
-        self.current_token = self.next_token
-        self.next_token = None
+        if self.current_token is not None:
+            self.previous_offset = self.current_token.offset
 
-        char = self.file.read(1)
-        if not char:
+        if self.replayed_tokens:
+            self.current_token = self.replayed_tokens.popleft()
             return
 
-        # Loop to skip comments and whitespaces as long as we can
-        while True:
-            while char in string.whitespace:
-                char = self.file.read(1)
-                if not char:
-                    return
-
-            if char != "/":
-                break
-
-            previous_position = self.file.tell()
-            previous_char = char
-            char = self.file.read(1)
-            if not char:
-                return
-
-            if char == "/":  # Line comment //
-                while True:
-                    char = self.file.read(1)
-                    if not char:
-                        return
-
-                    if char == "\n":  # Seen \n
-                        break
-            elif char == "*":  # Block comment /* */
-                # Skip until */
-                while True:
-                    char = self.file.read(1)
-                    if not char:
-                        return
-
-                    if char == "*":
-
-                        char = self.file.read(1)
-                        if not char:
-                            return
-
-                        if char == "/":
-                            char = self.file.read(1)
-                            if not char:
-                                return
-
-                            break  # Seen */
-            else:
-                # We have to reverse looking ahead one character
-                self.file.seek(previous_position)
-                char = previous_char
-                break
-
-        # Look ahead one character
-        if char in jack_symbols:
-            self.current_token = JackToken(TOKEN_TYPE.SYMBOL, char)
+        self.current_token = None
+        self.position = _skip_pattern.match(self.text, self.position).end()
+        match = _token_pattern.match(self.text, self.position)
+        if not match:
+            self.position = len(self.text)
             return
+        self.position = match.end()
+
+        kind = match.lastgroup
+        offset = match.start(kind)
+        if kind == "symbol":
+            self.current_token = JackToken(TOKEN_TYPE.SYMBOL, match.group(kind), offset)
+        elif kind == "int_const":
+            self.current_token = JackToken(TOKEN_TYPE.INT_CONST, match.group(kind), offset)
+        elif kind == "string_const":
+            # The offset of a string constant is the one of its opening quote
+            self.current_token = JackToken(TOKEN_TYPE.STRING_CONST, match.group(kind), offset - 1)
+        elif match.group(kind) in jack_keywords:
+            self.current_token = JackToken(TOKEN_TYPE.KEYWORD, match.group(kind), offset)
+        else:
+            self.current_token = JackToken(TOKEN_TYPE.IDENTIFIER, match.group(kind), offset)
+
+        if self.token_writer is not None:
+            self.token_writer.write_token(self.current_token)
+
+    def line_of(self, offset):
+        """Get the line number of a position in the source text.
 
-        # INT_CONST
-        if char.isnumeric():
-            value = char
-            while True:
-                current_position = self.file.tell()
-                char = self.file.read(1)
-                if not char or not char.isnumeric():
-                    self.file.seek(current_position)
-                    break
-                value = value + char
-            self.current_token = JackToken(TOKEN_TYPE.INT_CONST, value)
-            return
+        Args:
+            offset (int): The position, as stored in JackToken.offset.
 
-        # STRING_CONST
-        if char == "\"":
-            value = ""
-            char = self.file.read(1)
-            while char and char != "\"":
-                value = value + char
-                char = self.file.read(1)
-            if value:
-                self.current_token = JackToken(TOKEN_TYPE.STRING_CONST, value)
-            return
+        Returns:
+            int: The line number, starting at 1.
+        """
+        if self.line_starts is None:
+            self.line_starts = [0] + [match.end() for match in re.finditer("\n", self.text)]
+        return bisect_right(self.line_starts, offset)
+
+    def replay(self, tokens):
+        """Go back to tokens that were already read.
+
+        The first of the tokens becomes the current token, the rest follow, and after them the
+        current token is read again.
 
-        value = char
-        while True:
-            current_position = self.file.tell()
-            char = self.file.read(1)
-            if not char or char in string.whitespace or char in jack_symbols:
-                self.file.seek(current_position)
-                break
-            value = value + char
-        if value in keyword_str_to_constant:
-            # KEYWORD
-            self.current_token = JackToken(TOKEN_TYPE.KEYWORD, value)
-        else:  # IDENTIFIER
-            if value:
-                self.current_token = JackToken(TOKEN_TYPE.IDENTIFIER, value)
-        return
+        Args:
+            tokens (list): The tokens to go back to, in input order.
+        """
+        if not tokens:
+            return
+        self.replayed_tokens.appendleft(self.current_token)
+        self.replayed_tokens.extendleft(reversed(tokens[1:]))
+        self.current_token = tokens[0]
 
     def token_type(self):
         """Get the type of the current token.
 
         Returns:
-            TOKEN_TYPE: The type of the current token as a constant.
+            TOKEN_TYPE: The type of the current token as a constant, or None at the end of the input.
         """
+        if self.current_token is None:
+            return None
         return self.current_token.token_type
 
     def key_word(self):
@@ -0,0 +1,127 @@
+'''
+Links the .vm files of a program into one bundle. The bundle starts with an index of all
+functions, so loaders can seek to a function without scanning the code:
+
+// bundle 2                         number of index entries
+// Main.main 1 0000000073           function, local count, byte offset of its function command
+// Main.helper 0 0000000131
+// end
+function Main.main 1
+...
+
+The index consists of VM comments, so plain VM tools can still parse the bundle. Statics
+belong to the class named in the function name, as if each class were still in its own file.
+Offsets are written with a fixed width, so the index size is known before the offsets are.
+
+When deduplicating, a function with the same code as an earlier one is left out and its index
+entry points to the code of the earlier one. Such bundles need a loader that uses the index.
+'''
+
+from pathlib import Path
+
+OFFSET_WIDTH = 10
+
+
+def read_functions(vm_path):
+    """Splits a .vm file into its functions.
+
+    Returns:
+        list: (name, local count, code) for every function, where code is the text from the
+        function command up to the next one, without comments and empty lines.
+    """
+    functions = []
+    with open(vm_path, 'r', encoding='UTF-8') as file:
+        for line in file:
+            command = line.split("//", 1)[0].strip()
+            if not command:
+                continue
+            if command.startswith("function "):
+                _, name, var_count = command.split()
+                functions.append((name, int(var_count), []))
+            elif not functions:
+                raise ValueError(f"Link Error: Code outside of a function in {vm_path}")
+            else:
+                functions[-1][2].append(command + "\n")
+    return [(name, var_count, f"function {name} {var_count}\n" + "".join(lines))
+            for name, var_count, lines in functions]
+
+
+def identity_of(name, var_count, code):
+    # Identical code reads different statics in different classes
+    body = code.split("\n", 1)[1]
+    class_name = name.split(".")[0] if "static" in body else None
+    return (class_name, var_count, body)
+
+
+def link(vm_paths, bundle_path, dedupe=False):
+    """Writes the functions of all vm_paths, in order, into one bundle.
+
+    Args:
+        vm_paths (list): The .vm files to link.
+        bundle_path (Path): The bundle to write.
+        dedupe (bool): If True, functions with the same code share it.
+    """
+    # (name, local count, index of the code in codes)
+    entries = []
+    codes = []
+    names = set()
+    code_indices = {}
+    for vm_path in vm_paths:
+        for name, var_count, code in read_functions(vm_path):
+            if name in names:
+                raise ValueError(f"Link Error: Function {name} is defined twice, again in {vm_path}")
+            names.add(name)
+            identity = identity_of(name, var_count, code)
+            if dedupe and identity in code_indices:
+                entries.append((name, var_count, code_indices[identity]))
+                continue
+            code_indices[identity] = len(codes)
+            entries.append((name, var_count, len(codes)))
+            codes.append(code)
+
+    header_size = len(f"// bundle {len(entries)}\n".encode('UTF-8')) + len("// end\n")
+    for name, var_count, _ in entries:
+        header_size += len(f"// {name} {var_count} {0:0{OFFSET_WIDTH}d}\n".encode('UTF-8'))
+
+    code_offsets = []
+    offset = header_size
+    for code in codes:
+        code_offsets.append(offset)
+        offset += len(code.encode('UTF-8'))
+
+    header = [f"// bundle {len(entries)}\n"]
+    for name, var_count, code_index in entries:
+        header.append(f"// {name} {var_count} {code_offsets[code_index]:0{OFFSET_WIDTH}d}\n")
+    header.append("// end\n")
+    with open(bundle_path, 'w', encoding='UTF-8', newline="\n") as file:
+        file.write("".join(header + codes))
+
+
+def link_program(program_dir_or_file, bundle_path, os_dir=None, dedupe=False):
+    """Links the compiled classes of a program, followed by the OS classes in os_dir that the
+    program does not define itself."""
+    path = Path(program_dir_or_file)
+    jack_paths = [path] if path.is_file() else sorted(path.glob('*.jack'))
+    vm_paths = [jack_path.with_suffix(".vm") for jack_path in jack_paths]
+    if os_dir is not None:
+        program_classes = {vm_path.stem for vm_path in vm_paths}
+        vm_paths += [vm_path for vm_path in sorted(Path(os_dir).glob('*.vm'))
+                     if vm_path.stem not in program_classes]
+    link(vm_paths, bundle_path, dedupe)
+
+
+def load_bundle_index(path):
+    """Reads the index of a bundle.
+
+    Returns:
+        dict: Maps every function name to (local count, byte offset of its function command).
+    """
+    index = {}
+    with open(path, 'r', encoding='UTF-8', newline="\n") as file:
+        header = file.readline().split()
+        if len(header) != 3 or header[:2] != ["//", "bundle"]:
+            raise ValueError(f"Link Error: {path} is not a bundle")
+        for _ in range(int(header[2])):
+            _, name, var_count, offset = file.readline().split()
+            index[name] = (int(var_count), int(offset))
+    return index
@@ -0,0 +1,104 @@
+'''
+Finds the expressions of a while loop whose value is the same on every pass, so that the
+compilation engine can compute them once before the loop. The loop is analysed in its compiled
+VM code: simulating the stack shows which lines compute each value, and a value is invariant if
+it is computed only from constants, variables the loop never assigns and pure operations.
+
+Fields, statics and array elements are never treated as invariant, since any call or array
+store in the loop may change them.
+'''
+
+from collections import namedtuple
+
+UNARY_COMMANDS = {"neg", "not"}
+BINARY_COMMANDS = {"add", "sub", "and", "or", "eq", "gt", "lt"}
+# OS functions without side effects that take two values and return one. Calls with any other
+# number of arguments are treated like calls of unknown functions.
+PURE_FUNCTIONS = {"Math.multiply", "Math.divide"}
+
+# A value on the stack, computed by the lines from start to end. computed is True if it needs at
+# least one binary operation, only those are worth hoisting.
+Value = namedtuple("Value", ["start", "end", "invariant", "computed"])
+
+
+def find_invariant_ranges(lines, condition_end):
+    """Finds the largest loop invariant expressions of a while loop.
+
+    Args:
+        lines (list): The VM lines of the loop, from its start label to its end label.
+        condition_end (int): Lines before this index belong to the condition, which runs at
+            least once. Math.divide is only hoisted from there, and only if no call that may
+            have side effects comes before it, so that hoisting never makes a division by zero
+            happen earlier than, or when, the loop itself would not have done it.
+
+    Returns:
+        list: Sorted, non-overlapping (start, end) ranges of lines, each of which pushes one
+        invariant value and can be replaced by a push of that value.
+    """
+    assigned = set()
+    for line in lines:
+        if line.startswith("pop "):
+            _, segment, index = line.split()
+            # Indices stay strings, an undefined variable compiles to "None"
+            assigned.add((segment, index))
+
+    ranges = []
+    # Whether a call that may have side effects was seen in the condition
+    condition_has_call = False
+
+    def consume(value):
+        if value.invariant and value.computed:
+            ranges.append((value.start, value.end))
+
+    stack = []
+    for position, line in enumerate(lines):
+        command = line.split()
+        if not command:
+            continue
+        operation = command[0]
+        if operation == "push":
+            segment, index = command[1], command[2]
+            stack.append(Value(
+                position, position + 1, is_invariant_operand(segment, index, assigned), False))
+        elif operation in UNARY_COMMANDS:
+            value = stack.pop()
+            # Only values computed right before an operation can be hoisted together with it
+            invariant = value.invariant and value.end == position
+            if not invariant:
+                consume(value)
+            stack.append(Value(value.start, position + 1, invariant, value.computed))
+        elif operation in BINARY_COMMANDS or (
+                operation == "call" and command[1] in PURE_FUNCTIONS and command[2] == "2"):
+            right = stack.pop()
+            left = stack.pop()
+            invariant = (left.invariant and right.invariant
+                         and left.end == right.start and right.end == position)
+            if operation == "call" and command[1] == "Math.divide":
+                invariant = invariant and position < condition_end and not condition_has_call
+            if not invariant:
+                consume(left)
+                consume(right)
+            stack.append(Value(left.start, position + 1, invariant, True))
+        elif operation == "call":
+            condition_has_call = condition_has_call or position < condition_end
+            arg_count = int(command[2])
+            args = stack[len(stack) - arg_count:]
+            del stack[len(stack) - arg_count:]
+            for arg in args:
+                consume(arg)
+            stack.append(Value(args[0].start if args else position, position + 1, False, True))
+        elif operation in ["pop", "if-goto"]:
+            consume(stack.pop())
+        else:
+            # Labels, gotos and returns end a basic block, where the stack holds no expression
+            stack.clear()
+
+    return sorted(ranges)
+
+
+def is_invariant_operand(segment, index, assigned):
+    if segment == "constant":
+        return True
+    if segment in ["local", "argument"] or (segment, index) == ("pointer", "0"):
+        return (segment, index) not in assigned
+    return False
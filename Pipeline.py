@@ -0,0 +1,103 @@
+'''
+Overlaps the file I/O of a directory compile with compiling. A reader thread loads upcoming
+sources into memory, the caller compiles them one by one in order, and a writer thread writes
+the finished output files. Both queues are bounded, so at most a few sources and outputs are
+held in memory at a time.
+'''
+
+import queue
+import threading
+
+# Number of sources read ahead and of output files waiting to be written
+DEFAULT_QUEUE_DEPTH = 4
+
+
+class SourceReader:
+    """
+    Reads files on a background thread, in the order given. Iterating yields (path, text) pairs in
+    the same order; a file that could not be read raises its error when its turn comes, so errors
+    are reported exactly as a sequential compile would report them.
+    """
+
+    def __init__(self, paths, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.paths = paths
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read_all, daemon=True)
+        self.thread.start()
+
+    def read_all(self):
+        try:
+            for path in self.paths:
+                if self.stopped.is_set():
+                    return
+                try:
+                    with open(path, 'r', encoding="utf-8") as file:
+                        text = file.read()
+                except Exception as error:
+                    # Also decoding errors, which the consumer raises like a sequential compile
+                    self.queue.put((path, None, error))
+                    return
+                self.queue.put((path, text, None))
+        finally:
+            # Without the end marker the consumer would wait forever
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, text, error = item
+            if error is not None:
+                raise error
+            yield path, text
+
+    def close(self):
+        """Stops reading ahead, also when the caller did not consume every file."""
+        self.stopped.set()
+        # Make room, so a thread blocked on a full queue sees the stop
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+
+class OutputWriter:
+    """
+    Writes files on a background thread, in the order they were handed to write(). Each file is
+    written with a single call. The first error is raised again by close().
+    """
+
+    def __init__(self, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_all, daemon=True)
+        self.thread.start()
+
+    def write_all(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, content = item
+            if self.error is not None:
+                continue
+            # Any error is kept, the thread has to go on draining the queue so write() never blocks
+            try:
+                with open(path, 'w', encoding='UTF-8') as file:
+                    file.write(content)
+            except Exception as error:
+                self.error = error
+
+    def write(self, path, content):
+        self.queue.put((path, content))
+
+    def close(self):
+        """Waits until every file handed to write() is written."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,82 @@
+'''
+An execution profile records how often parts of the compiled VM code ran. Every line of a
+profile file holds a name and a count, separated by whitespace:
+
+Main.main 1                     number of calls of the function Main.main
+Main.main$IF_FALSE2 57          number of times the label IF_FALSE2 in Main.main was passed
+
+Labels are scoped to their function, which matches how VM translators name them.
+Empty lines and lines starting with '#' are ignored.
+'''
+
+
+class Profile:
+    # Functions that together account for this share of the total weight are hot
+    HOT_WEIGHT_SHARE = 0.9
+
+    def __init__(self, counts):
+        # name -> count
+        self.counts = counts
+        self.hot_functions = self.find_hot_functions()
+
+    def find_hot_functions(self):
+        # The weight of a function is its number of calls plus the number of times labels in it
+        # were passed, which roughly measures how much work was done in it
+        weights = {}
+        for name, count in self.counts.items():
+            function_name = name.split("$", 1)[0]
+            weights[function_name] = weights.get(function_name, 0) + count
+
+        total = sum(weights.values())
+        hot_functions = set()
+        covered = 0
+        for function_name, weight in sorted(weights.items(), key=lambda item: (-item[1], item[0])):
+            if weight == 0 or covered >= total * self.HOT_WEIGHT_SHARE:
+                break
+            hot_functions.add(function_name)
+            covered += weight
+        return hot_functions
+
+    def is_hot(self, function_name):
+        return function_name in self.hot_functions
+
+    def branch_counts(self, function_name, label_num):
+        """Returns how often the then and the else branch of an if statement were taken.
+
+        Works for profiles recorded with either branch layout: IF_FALSE<n> is only reached when
+        the else branch is taken, IF_TRUE<n> only when the then branch is taken, and IF_END<n>
+        is reached by both.
+
+        Args:
+            function_name (str): The function containing the if statement, as Class.subroutine.
+            label_num (int): The number of the if statement's labels.
+
+        Returns:
+            tuple: (then count, else count), or None if the profile has no data for the statement.
+        """
+        true_count = self.counts.get(f"{function_name}$IF_TRUE{label_num}")
+        false_count = self.counts.get(f"{function_name}$IF_FALSE{label_num}")
+        end_count = self.counts.get(f"{function_name}$IF_END{label_num}", 0)
+
+        if true_count is None and false_count is None:
+            return None
+        if true_count is None:
+            true_count = max(end_count - false_count, 0)
+        if false_count is None:
+            false_count = max(end_count - true_count, 0)
+        return true_count, false_count
+
+
+def load_profile(path):
+    counts = {}
+    with open(path, 'r', encoding="utf-8") as profile_file:
+        for line_number, line in enumerate(profile_file, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) != 2 or not parts[1].isdigit():
+                raise ValueError(
+                    f"Profile Error: Expected 'name count' in line {line_number} of {path}")
+            counts[parts[0]] = counts.get(parts[0], 0) + int(parts[1])
+    return Profile(counts)
@@ -1,9 +1,8 @@
 from enum import Enum
+from types import MappingProxyType
 
-jack_symbols = [
-    "{", "}", "(", ")", "[", "]", ".", ",", ";", "+",
-    "-", "*", "/", "&", "|", "<", ">", "=", "~"
-]
+# The symbols of the Jack language, as the contents of a regular expression character class
+jack_symbol_class = r"{}()\[\].,;+\-*/&|<>=~"
 
 
 class TOKEN_TYPE(Enum):
@@ -38,12 +37,17 @@ class KEYWORD(Enum):
     THIS = 21
 
 
-keyword_str_to_constant = {item.name.lower(): item.name for item in KEYWORD}
+# The names of the KEYWORD members in lower case, written out so importing does no work
+jack_keywords = frozenset({
+    "class", "method", "function", "constructor", "int", "boolean", "char", "void", "var",
+    "static", "field", "let", "do", "if", "else", "while", "return", "true", "false", "null",
+    "this"
+})
 
-token_type_to_xml_tag = {
+token_type_to_xml_tag = MappingProxyType({
     TOKEN_TYPE.KEYWORD: "keyword",
     TOKEN_TYPE.SYMBOL: "symbol",
     TOKEN_TYPE.IDENTIFIER: "identifier",
     TOKEN_TYPE.INT_CONST: "integerConstant",
     TOKEN_TYPE.STRING_CONST: "stringConstant"
-}
+})
@@ -0,0 +1,56 @@
+'''
+A source map links the lines of a .vm file to the lines of the .jack file they were compiled
+from. It is written next to the .vm file, with ".map" appended to its name:
+
+source Main.jack        name of the source file
+1 3                     VM lines from 1 on come from source line 3
+7 4                     VM lines from 7 on come from source line 4
+
+Only the VM lines at which the source line changes are listed, line numbers start at 1.
+'''
+
+from bisect import bisect_right
+
+
+class SourceMap:
+    def __init__(self, source_name, vm_lines, source_lines):
+        self.source_name = source_name
+        # Sorted VM line numbers at which a run starts, and the source line of each run
+        self.vm_lines = vm_lines
+        self.source_lines = source_lines
+
+    def source_line_of(self, vm_line):
+        """Returns the source line a VM line was compiled from, or None if it is not known."""
+        run = bisect_right(self.vm_lines, vm_line) - 1
+        return self.source_lines[run] if run >= 0 else None
+
+
+def format_source_map(source_name, source_lines):
+    """Returns the content of a source map file.
+
+    Args:
+        source_name (str): The name of the source file.
+        source_lines (list): The source line of every VM line, None where unknown, which
+            continues the previous run.
+    """
+    entries = [f"source {source_name}\n"]
+    previous = None
+    for vm_line, source_line in enumerate(source_lines, start=1):
+        if source_line is not None and source_line != previous:
+            entries.append(f"{vm_line} {source_line}\n")
+            previous = source_line
+    return "".join(entries)
+
+
+def load_source_map(path):
+    with open(path, 'r', encoding='UTF-8') as file:
+        header = file.readline().split(maxsplit=1)
+        if len(header) != 2 or header[0] != "source":
+            raise ValueError(f"Source Map Error: Missing source line in {path}")
+        vm_lines = []
+        source_lines = []
+        for line in file:
+            vm_line, source_line = line.split()
+            vm_lines.append(int(vm_line))
+            source_lines.append(int(source_line))
+    return SourceMap(header[1].strip(), vm_lines, source_lines)
@@ -0,0 +1,91 @@
+'''
+Reports how long the compiler takes to start. The compile runs in a new interpreter with
+"-X importtime", and the time spent importing each top level module in the fastest of a few
+runs is listed, slowest first.
+Modules every interpreter imports on startup are left out, the total of the rest is compared
+against STARTUP_TARGET_MS, and "JackAnalyzer.py --startup-report" fails if it is missed, so
+benchmark runs can check the target.
+
+Most calls compile a single small file, so startup is a large part of their run time. Modules
+that only some options need are therefore imported when the option is used, see JackAnalyzer.
+'''
+
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Time the imports of a single file compile should stay below, in milliseconds
+STARTUP_TARGET_MS = 20
+
+# The fastest of this many runs is reported, since single runs vary a lot
+RUNS = 5
+
+# Imports taking less than this are not listed, in milliseconds
+MIN_REPORTED_MS = 0.1
+
+
+def run_with_import_times(arguments):
+    """Runs a new interpreter with the given arguments.
+
+    Returns:
+        tuple: The wall time of the run in milliseconds, a list of (module name, milliseconds)
+        for every top level import, including the imports it caused, and the completed process.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + arguments, capture_output=True, text=True)
+    wall_time = (time.perf_counter() - start) * 1000
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented below the one causing them
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return wall_time, imports, result
+
+
+def measure_startup(arguments):
+    """Compiles with the given command line arguments in a new interpreter.
+
+    Returns:
+        tuple: The wall time of the compile and of an interpreter doing nothing, both in
+        milliseconds, and (module name, milliseconds) for every top level import of the compile
+        that an interpreter doing nothing does not import.
+    """
+    idle_time, idle_imports, _ = run_with_import_times(["-c", "pass"])
+    wall_time, imports, result = run_with_import_times(
+        [str(Path(__file__).with_name("JackAnalyzer.py"))] + arguments)
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        raise ValueError("Startup Report Error: The compile failed\n" + "\n".join(errors))
+    interpreter_modules = {name for name, _ in idle_imports}
+    return wall_time, idle_time, [entry for entry in imports if entry[0] not in interpreter_modules]
+
+
+def write_startup_report(arguments, file=sys.stdout):
+    """Reports the startup of a compile with the given command line arguments.
+
+    Returns:
+        bool: Whether the imports stayed within STARTUP_TARGET_MS.
+    """
+    runs = []
+    for _ in range(RUNS):
+        wall_time, idle_time, imports = measure_startup(arguments)
+        runs.append((sum(milliseconds for _, milliseconds in imports), wall_time, idle_time, imports))
+    import_time, wall_time, idle_time, imports = min(runs, key=lambda run: run[0])
+
+    lines = [f"{'import':<32}{'ms':>8}"]
+    for name, milliseconds in sorted(imports, key=lambda entry: entry[1], reverse=True):
+        if milliseconds >= MIN_REPORTED_MS:
+            lines.append(f"{name:<32}{milliseconds:>8.1f}")
+    lines.append(f"{'all imports':<32}{import_time:>8.1f}")
+    lines.append(f"{'whole run':<32}{wall_time:>8.1f}")
+    lines.append(f"{'interpreter doing nothing':<32}{idle_time:>8.1f}")
+    target_met = import_time <= STARTUP_TARGET_MS
+    lines.append(f"Import target of {STARTUP_TARGET_MS} ms {'met' if target_met else 'missed'}")
+    print("\n".join(lines), file=file)
+    return target_met
@@ -0,0 +1,45 @@
+'''
+Stores the compiled VM code of single subroutines between compiler runs, so that a class only
+needs to recompile the subroutines that changed. The compilation engine computes the keys, see
+CompilationEngine.subroutine_cache_key.
+'''
+
+import os
+from pathlib import Path
+from VMWriter import VMCode
+
+
+class SubroutineCache:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_of(self, key, suffix):
+        return self.directory / f"{key}{suffix}"
+
+    def get(self, key, start_offset):
+        """Returns the cached VMCode for key, with source offsets relative to start_offset."""
+        try:
+            with open(self.path_of(key, ".vm"), 'r', encoding='UTF-8') as file:
+                lines = file.read().splitlines(keepends=True)
+            with open(self.path_of(key, ".offsets"), 'r', encoding='UTF-8') as file:
+                offsets = [
+                    None if offset == "-" else start_offset + int(offset) for offset in file.read().split()]
+        except FileNotFoundError:
+            return None
+        if len(offsets) != len(lines):
+            return None
+        return VMCode(lines, offsets)
+
+    def put(self, key, code, start_offset):
+        offsets = ["-" if offset is None else str(offset - start_offset) for offset in code.offsets]
+        # The offsets are written last, so entries written partially by an aborted run are ignored
+        self.write(self.path_of(key, ".vm"), "".join(code.lines))
+        self.write(self.path_of(key, ".offsets"), "\n".join(offsets))
+
+    def write(self, path, content):
+        # Write to a temporary file first, so concurrent compiles never see a partial file
+        temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, 'w', encoding='UTF-8') as file:
+            file.write(content)
+        os.replace(temporary_path, path)
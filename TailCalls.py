@@ -0,0 +1,110 @@
+'''
+Finds the calls of a subroutine to itself whose result it returns right away. The compilation
+engine replaces them by assigning the new arguments and jumping back to the start of the
+subroutine, so such recursion runs in constant stack space.
+'''
+
+UNARY_COMMANDS = {"neg", "not"}
+BINARY_COMMANDS = {"add", "sub", "and", "or", "eq", "gt", "lt"}
+# Commands that end the straight line code at the start of a subroutine
+CONTROL_COMMANDS = {"label", "goto", "if-goto", "return"}
+
+
+def find_tail_calls(lines, function_name, arg_count, is_method):
+    """Finds the self-recursive calls in tail position.
+
+    Args:
+        lines (list): The VM lines of the subroutine body, after the subroutine prologue.
+        function_name (str): The VM name of the subroutine, like "Main.sum".
+        arg_count (int): The number of arguments of the subroutine, including this for methods.
+        is_method (bool): If True, only calls on this are tail calls.
+
+    Returns:
+        list: The positions of the call commands, each of which is directly followed by a
+        return.
+    """
+    call = f"call {function_name} {arg_count}\n"
+    tail_calls = []
+    for position in range(len(lines) - 1):
+        if lines[position] != call or lines[position + 1] != "return\n":
+            continue
+        if is_method and not passes_this(lines, position, arg_count):
+            continue
+        tail_calls.append(position)
+    return tail_calls
+
+
+def passes_this(lines, call_position, arg_count):
+    """Returns whether the first argument of the call at call_position is just this."""
+    start = find_arguments_start(lines, call_position, arg_count)
+    if start is None or lines[start] != "push pointer 0\n":
+        return False
+    # The remaining arguments must leave the pushed this untouched
+    depth = 1
+    for line in lines[start + 1:call_position]:
+        popped, pushed = stack_effect(line)
+        if depth - popped < 1:
+            return False
+        depth += pushed - popped
+    return True
+
+
+def find_arguments_start(lines, call_position, arg_count):
+    """Returns the position of the first line pushing the arguments of a call, or None."""
+    needed = arg_count
+    position = call_position
+    while needed > 0:
+        position -= 1
+        if position < 0:
+            return None
+        popped, pushed = stack_effect(lines[position])
+        needed += popped - pushed
+    return position
+
+
+def stack_effect(line):
+    """Returns how many values a VM command pops from and pushes onto the stack."""
+    command = line.split()
+    if not command:
+        return 0, 0
+    operation = command[0]
+    if operation == "push":
+        return 0, 1
+    if operation in ["pop", "if-goto"]:
+        return 1, 0
+    if operation in UNARY_COMMANDS:
+        return 1, 1
+    if operation in BINARY_COMMANDS:
+        return 2, 1
+    if operation == "call":
+        return int(command[2]), 1
+    return 0, 0
+
+
+def find_locals_to_reset(lines):
+    """Finds the locals a jump back to the start of the subroutine has to reset to 0.
+
+    These are the locals that are read anywhere, except those the straight line code at the
+    start of the subroutine always assigns before reading them.
+
+    Args:
+        lines (list): The VM lines of the subroutine body, after the subroutine prologue.
+
+    Returns:
+        list: The sorted indices of the locals.
+    """
+    read = {int(line.split()[2]) for line in lines if line.startswith("push local ")}
+    assigned_first = set()
+    seen = set()
+    for line in lines:
+        command = line.split()
+        if not command:
+            continue
+        if command[0] in CONTROL_COMMANDS:
+            break
+        if command[0] in ["push", "pop"] and command[1] == "local":
+            index = int(command[2])
+            if command[0] == "pop" and index not in seen:
+                assigned_first.add(index)
+            seen.add(index)
+    return sorted(read - assigned_first)
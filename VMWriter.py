@@ -1,39 +1,138 @@
+from collections import namedtuple
+
+# A piece of emitted code: its lines and the source offset each line was compiled from
+VMCode = namedtuple("VMCode", ["lines", "offsets"])
+
+
 class VMWriter:
-    def __init__(self, output_path):
-        self.file = open(output_path, 'w', encoding='UTF-8')
+    """
+    Emits VM commands for one class. Commands are buffered in memory and written to the output
+    file on close, so the compilation engine can set aside and reorder already emitted code.
+    """
+
+    def __init__(self, output_path, tokenizer=None, source_name=None, file_writer=None):
+        """
+        Args:
+            output_path (Path): The .vm file to write.
+            tokenizer (JackTokenizer, optional): Every command is attributed to the position of
+                the token the tokenizer consumed last.
+            source_name (str, optional): If given, a source map for the source file of this name
+                is written next to the .vm file.
+            file_writer (OutputWriter, optional): Writes the output files instead of close()
+                writing them directly, see Pipeline.
+        """
+        self.output_path = output_path
+        self.tokenizer = tokenizer
+        self.source_name = source_name
+        self.file_writer = file_writer
+        self.lines = []
+        # Source offset of every line, or None if unknown
+        self.offsets = []
+        # Array element THAT points to within the current basic block, or None if unknown. Stored
+        # as (base segment, base index, index segment, index index), see
+        # CompilationEngine.finish_array_index.
+        self.that_address = None
+
+    def emit(self, line):
+        self.lines.append(line)
+        self.offsets.append(self.tokenizer.previous_offset if self.tokenizer else None)
 
     def write_push(self, segment, index):
-        self.file.write(f"push {segment} {index}\n")
+        self.emit(f"push {segment} {index}\n")
 
     def write_pop(self, segment, index):
-        self.file.write(f"pop {segment} {index}\n")
+        self.emit(f"pop {segment} {index}\n")
+        if self.that_address and self.invalidates_that_address(segment, index):
+            self.that_address = None
 
     def write_arithmetic(self, command):
-        self.file.write(f"{command}\n")
+        self.emit(f"{command}\n")
 
     def write_label(self, label):
-        self.file.write(f"label {label}\n")
+        self.emit(f"label {label}\n")
+        # A new basic block starts, it can be reached from anywhere
+        self.that_address = None
 
     def write_goto(self, label):
-        self.file.write(f"goto {label}\n")
+        self.emit(f"goto {label}\n")
 
     def write_if_goto(self, label):
-        self.file.write(f"if-goto {label}\n")
+        self.emit(f"if-goto {label}\n")
 
     def write_call(self, name, nArgs):
-        self.file.write(f"call {name} {nArgs}\n")
+        self.emit(f"call {name} {nArgs}\n")
+        # THAT is restored on return, but the callee may change the variables the address depends on
+        self.that_address = None
 
     def write_function(self, name, nVars):
-        self.file.write(f"function {name} {nVars}\n")
+        self.emit(f"function {name} {nVars}\n")
+        self.that_address = None
+
+    def rewrite_function(self, mark, name, nVars):
+        """Replaces the function command emitted at mark, once the number of locals is final."""
+        self.lines[mark] = f"function {name} {nVars}\n"
 
     def write_return(self):
-        self.file.write(f"return\n")
+        self.emit(f"return\n")
 
     def write_comment(self, comment):
-        self.file.write(f"// {comment}\n")
+        self.emit(f"// {comment}\n")
 
     def write_empty_line(self):
-        self.file.write("\n")
+        self.emit("\n")
+
+    def invalidates_that_address(self, segment, index):
+        base_segment, base_index, index_segment, index_index = self.that_address
+        if segment == "pointer":
+            return True
+        if (segment, index) in [(base_segment, base_index), (index_segment, index_index)]:
+            return True
+        # Writing through THAT may change fields or statics used by the address, but arrays are
+        # assumed not to overlap the local and argument segments
+        if segment == "that":
+            return any(dependency in ["this", "static"] for dependency in [base_segment, index_segment])
+        return False
+
+    def mark(self):
+        """Returns a position in the emitted code that can later be passed to cut() or code_since()."""
+        return len(self.lines)
+
+    def code_since(self, mark):
+        """Returns a copy of everything emitted since mark as VMCode."""
+        return VMCode(self.lines[mark:], self.offsets[mark:])
+
+    def cut(self, mark):
+        """Removes and returns everything emitted since mark.
+
+        Args:
+            mark (int): A position previously returned by mark().
+
+        Returns:
+            VMCode: The removed code, which can be emitted again with write_code().
+        """
+        code = self.code_since(mark)
+        del self.lines[mark:]
+        del self.offsets[mark:]
+        return code
+
+    def write_code(self, code):
+        self.lines.extend(code.lines)
+        self.offsets.extend(code.offsets)
 
     def close(self):
-        self.file.close()
+        self.write_file(self.output_path, "".join(self.lines))
+
+        if self.source_name is not None:
+            from SourceMap import format_source_map
+            source_lines = [
+                None if offset is None else self.tokenizer.line_of(offset) for offset in self.offsets]
+            self.write_file(
+                self.output_path.with_name(self.output_path.name + ".map"),
+                format_source_map(self.source_name, source_lines))
+
+    def write_file(self, path, content):
+        if self.file_writer is not None:
+            self.file_writer.write(path, content)
+            return
+        with open(path, 'w', encoding='UTF-8') as file:
+            file.write(content)
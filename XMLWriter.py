@@ -0,0 +1,50 @@
+from Shared import token_type_to_xml_tag
+
+# Characters that have to be escaped in XML text, replaced in one pass per value by str.translate
+_xml_escapes = str.maketrans({"<": "&lt;", ">": "&gt;", "&": "&amp;", '"': "&quot;"})
+
+
+class XMLWriter:
+    """
+    Streams tokens and parse tree elements to an XML file in the format of the nand2tetris
+    tools. Nothing is kept in memory except a small buffer, which is written out whenever it fills.
+    """
+
+    # Number of buffered pieces of text after which the buffer is written to the file
+    FLUSH_SIZE = 4096
+
+    def __init__(self, output_path, indent="  "):
+        """
+        Args:
+            output_path (Path): The .xml file to write.
+            indent (str): Added in front of an element for every enclosing element.
+        """
+        self.file = open(output_path, 'w', encoding='UTF-8')
+        self.indent = indent
+        self.level = 0
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+        if len(self.buffer) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def open_element(self, tag):
+        self.write(f"{self.indent * self.level}<{tag}>\n")
+        self.level += 1
+
+    def close_element(self, tag):
+        self.level -= 1
+        self.write(f"{self.indent * self.level}</{tag}>\n")
+
+    def write_token(self, token):
+        tag = token_type_to_xml_tag[token.token_type]
+        self.write(f"{self.indent * self.level}<{tag}> {token.value.translate(_xml_escapes)} </{tag}>\n")
+
+    def flush(self):
+        self.file.write("".join(self.buffer))
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
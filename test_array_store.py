@@ -0,0 +1,100 @@
+'''
+Checks that array stores reusing the THAT pointer still write to and read from the right
+elements, also when the value changes the variables the address depends on.
+'''
+
+import unittest
+from test_if_layout import Machine, compile_class, function_code
+
+SOURCE = '''
+class Main {
+    static int k;
+    field int i, j;
+    field Array a;
+
+    constructor Main new() {
+        let a = this;
+        let j = 42;
+        return this;
+    }
+
+    function int increment(int n) {
+        var Array a;
+        var int i;
+        let a = Array.new(3);
+        let i = 1;
+        let a[i] = n;
+        let a[i] = a[i] + 1;
+        let a[i] = a[i] + a[i];
+        return a[i];
+    }
+
+    function int bump() {
+        let k = k + 1;
+        return k;
+    }
+
+    function int staticIndex() {
+        var Array a;
+        var int x;
+        let a = Array.new(6);
+        let a[3] = 30;
+        let k = 2;
+        let x = a[k];
+        let a[k] = Main.bump() + a[k];
+        let a[k] = a[k] + Main.bump();
+        let a[k] = Main.bump();
+        let x = x + a[k];
+        return (a[2] * 100) + a[3] + x;
+    }
+
+    function int alias() {
+        var Array a, b;
+        let a = Array.new(2);
+        let b = a;
+        let a[0] = 1;
+        let b[0] = a[0] + 1;
+        let a[0] = a[0] + b[0];
+        return a[0];
+    }
+
+    method int fieldIndex() {
+        let i = 0;
+        let a[i] = 1;
+        return a[i];
+    }
+
+    function int runFieldIndex() {
+        var Main object;
+        let object = Main.new();
+        return object.fieldIndex();
+    }
+}
+'''
+
+
+class ArrayStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = compile_class(SOURCE)
+
+    def test_increment_reuses_that(self):
+        self.assertEqual(Machine(self.commands).run("Main.increment", [5]), 12)
+        code = function_code(self.commands, "Main.increment")
+        self.assertEqual(code.count(["pop", "pointer", "1"]), 1)
+
+    def test_static_index_changed_by_call_in_value(self):
+        machine = Machine(self.commands)
+        # The address is computed before the value, so each store uses the index before the call
+        self.assertEqual(machine.run("Main.staticIndex", []), 3334)
+        self.assertEqual(machine.statics["Main"][0], 5)
+
+    def test_store_through_alias(self):
+        self.assertEqual(Machine(self.commands).run("Main.alias", []), 4)
+
+    def test_field_index_changed_by_store(self):
+        # a points to the object itself, so storing to a[0] changes i
+        self.assertEqual(Machine(self.commands).run("Main.runFieldIndex", []), 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+'''
+Checks that the branch layout chosen from a profile never changes which branch of an if
+statement runs, also for conditions that are neither 0 nor -1. The other tests run compiled code
+with the Machine defined here.
+'''
+
+import collections
+import io
+import unittest
+from JackTokenizer import JackTokenizer
+from CompilationEngine import CompilationEngine
+from Profile import Profile
+from SymbolTable import SymbolTable
+from VMWriter import VMWriter
+
+SOURCE = '''
+class Main {
+    function int f(int x) {
+        var int r;
+        if (%s) { let r = 1; } else { let r = 2; }
+        return r;
+    }
+}
+'''
+
+CONDITIONS = ["x & 1", "x", "x < 3", "~(x = 0)", "-x", "~x"]
+VALUES = [0, -1, 1, 2, 5, -6, 32767]
+
+
+def compile_class(source, profile=None):
+    tokenizer = JackTokenizer(io.StringIO(source))
+    vm_writer = VMWriter(None, tokenizer)
+    CompilationEngine(tokenizer, vm_writer, SymbolTable(), profile).compile_class()
+    return [line.split() for line in vm_writer.lines if line.strip() and not line.startswith("//")]
+
+
+def function_code(commands, name):
+    start = next(position for position, command in enumerate(commands) if command[:2] == ["function", name])
+    end = next((position for position in range(start + 1, len(commands))
+                if commands[position][0] == "function"), len(commands))
+    return commands[start:end]
+
+
+def word(value):
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+class Halt(Exception):
+    """Raised when the program stops with an error, like the OS does on a division by zero."""
+
+
+class Machine:
+    """
+    Runs compiled VM code, supporting the commands the compiler emits and the few OS functions
+    the tests call. Calls are counted per function, and max_depth is the deepest the call stack
+    got, so tests can check how code runs and not only what it returns.
+    """
+
+    MAX_STEPS = 1000000
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.functions = {}
+        self.labels = {}
+        function = None
+        for position, command in enumerate(commands):
+            if command[0] == "function":
+                function = command[1]
+                self.functions[function] = position
+            elif command[0] == "label":
+                self.labels[function, command[1]] = position
+        self.memory = [0] * 0x8000
+        self.heap = 2048
+        self.statics = collections.defaultdict(lambda: [0] * 256)
+        self.temp = [0] * 8
+        self.output = []
+        self.calls = collections.Counter()
+        self.max_depth = 0
+        self.os_functions = {
+            "Math.multiply": lambda x, y: x * y, "Math.divide": self.divide,
+            "Memory.alloc": self.alloc, "Array.new": self.alloc, "Output.printInt": self.print_int}
+
+    def alloc(self, size):
+        address = self.heap
+        self.heap += size
+        return address
+
+    def divide(self, x, y):
+        if y == 0:
+            raise Halt("Division by zero")
+        return int(x / y)
+
+    def print_int(self, value):
+        self.output.append(value)
+        return 0
+
+    def run(self, name, arguments):
+        """Calls the function name with the given arguments and returns its result."""
+        stack = list(arguments)
+        frames = []
+        self.call(frames, stack, name, len(arguments))
+        for _ in range(self.MAX_STEPS):
+            if not frames:
+                return stack.pop()
+            frame = frames[-1]
+            command = self.commands[frame["position"]]
+            frame["position"] += 1
+            operation = command[0]
+            if operation == "push":
+                if command[1] == "constant":
+                    stack.append(int(command[2]))
+                else:
+                    values, index = self.locate(frame, command[1], int(command[2]))
+                    stack.append(values[index])
+            elif operation == "pop":
+                values, index = self.locate(frame, command[1], int(command[2]))
+                values[index] = stack.pop()
+            elif operation in ["neg", "not"]:
+                value = stack.pop()
+                stack.append(-value if operation == "neg" else ~value)
+            elif operation in ["add", "sub", "and", "or", "eq", "lt", "gt"]:
+                right = stack.pop()
+                left = stack.pop()
+                stack.append(word({
+                    "add": lambda: left + right, "sub": lambda: left - right,
+                    "and": lambda: left & right, "or": lambda: left | right,
+                    "eq": lambda: -(left == right), "lt": lambda: -(left < right),
+                    "gt": lambda: -(left > right)}[operation]()))
+            elif operation == "goto":
+                frame["position"] = self.labels[frame["function"], command[1]]
+            elif operation == "if-goto":
+                if stack.pop() != 0:
+                    frame["position"] = self.labels[frame["function"], command[1]]
+            elif operation == "call":
+                self.call(frames, stack, command[1], int(command[2]))
+            elif operation == "return":
+                frames.pop()
+        raise AssertionError(f"{name} did not return within {self.MAX_STEPS} steps")
+
+    def call(self, frames, stack, name, arg_count):
+        self.calls[name] += 1
+        arguments = stack[len(stack) - arg_count:]
+        del stack[len(stack) - arg_count:]
+        if name in self.os_functions:
+            stack.append(word(self.os_functions[name](*arguments)))
+            return
+        position = self.functions[name]
+        frames.append({
+            "function": name, "position": position + 1, "argument": arguments,
+            "local": [0] * int(self.commands[position][2]), "pointer": [0, 0]})
+        self.max_depth = max(self.max_depth, len(frames))
+
+    def locate(self, frame, segment, index):
+        """Returns the list holding the given memory segment entry and the index into it."""
+        if segment in ["argument", "local", "pointer"]:
+            return frame[segment], index
+        if segment == "static":
+            return self.statics[frame["function"].split(".")[0]], index
+        if segment == "temp":
+            return self.temp, index
+        if segment == "this":
+            return self.memory, frame["pointer"][0] + index
+        return self.memory, frame["pointer"][1] + index
+
+
+class IfLayoutTest(unittest.TestCase):
+    def test_flipped_layout_takes_the_same_branch(self):
+        hot_else = Profile({"Main.f": 1, "Main.f$IF_FALSE0": 100, "Main.f$IF_END0": 100})
+        for condition in CONDITIONS:
+            normal = compile_class(SOURCE % condition)
+            flipped = compile_class(SOURCE % condition, hot_else)
+            self.assertIn(["if-goto", "IF_TRUE0"], flipped)
+            for value in VALUES:
+                with self.subTest(condition=condition, x=value):
+                    self.assertEqual(Machine(normal).run("Main.f", [value]),
+                                     Machine(flipped).run("Main.f", [value]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+'''
+Checks which expressions are hoisted out of while loops, and that the loops still compute the
+same values and stop with the same errors.
+'''
+
+import unittest
+from LoopInvariants import find_invariant_ranges
+from test_if_layout import Halt, Machine, compile_class, function_code
+
+SOURCE = '''
+class Main {
+    function int assigned(int a, int b) {
+        var int i, s;
+        while (i < 3) {
+            let s = s + (a * b);
+            let a = a + 1;
+            let i = i + 1;
+        }
+        return s;
+    }
+
+    function int repeated(int a, int b) {
+        var int i, s, t;
+        while (i < 4) {
+            let s = s + (a * b);
+            let t = t - (a * b);
+            let i = i + 1;
+        }
+        return s + s + t;
+    }
+
+    function int nested(int a, int b) {
+        var int i, j, s;
+        while (i < 3) {
+            let j = 0;
+            while (j < 4) {
+                let s = s + (a * b) + (i * b);
+                let j = j + 1;
+            }
+            let i = i + 1;
+        }
+        return s;
+    }
+
+    function int log(int x) {
+        do Output.printInt(x);
+        return -1;
+    }
+
+    function int divideInCondition(int x, int y) {
+        var int i;
+        while (i < (x / y)) {
+            let i = i + 1;
+        }
+        return i;
+    }
+
+    function int divideAfterCall(int x, int y) {
+        var int i;
+        while (Main.log(i) & (i < (x / y))) {
+            let i = i + 1;
+        }
+        return i;
+    }
+
+    function int divideInBody(int n, int x, int y) {
+        var int i, s;
+        while (i < n) {
+            let s = s + (x / y);
+            let i = i + 1;
+        }
+        return s;
+    }
+
+    function int unusualCalls(int a, int b, int c) {
+        var int i, s;
+        while (i < 3) {
+            let s = s + Math.multiply(a, b, c);
+            let i = Math.multiply(i);
+            let s = s + undefined;
+        }
+        return s;
+    }
+}
+'''
+
+
+class LoopInvariantTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = compile_class(SOURCE)
+
+    def run_function(self, name, arguments):
+        machine = Machine(self.commands)
+        return machine.run(name, arguments), machine
+
+    def test_assigned_variable_is_not_hoisted(self):
+        self.assertEqual(function_code(self.commands, "Main.assigned")[0], ["function", "Main.assigned", "2"])
+        result, machine = self.run_function("Main.assigned", [2, 3])
+        self.assertEqual(result, 6 + 9 + 12)
+        self.assertEqual(machine.calls["Math.multiply"], 3)
+
+    def test_repeated_expression_shares_one_local(self):
+        code = function_code(self.commands, "Main.repeated")
+        self.assertEqual(code[0], ["function", "Main.repeated", "4"])
+        self.assertEqual(code.count(["pop", "local", "3"]), 1)
+        result, machine = self.run_function("Main.repeated", [2, 3])
+        self.assertEqual(result, 4 * 6)
+        self.assertEqual(machine.calls["Math.multiply"], 1)
+
+    def test_nested_loops(self):
+        result, machine = self.run_function("Main.nested", [2, 3])
+        self.assertEqual(result, sum(4 * (6 + i * 3) for i in range(3)))
+        # a * b once for both loops, i * b once per pass of the outer loop
+        self.assertEqual(machine.calls["Math.multiply"], 1 + 3)
+
+    def test_divide_in_condition_is_hoisted(self):
+        result, machine = self.run_function("Main.divideInCondition", [10, 2])
+        self.assertEqual(result, 5)
+        self.assertEqual(machine.calls["Math.divide"], 1)
+        with self.assertRaises(Halt):
+            self.run_function("Main.divideInCondition", [10, 0])
+
+    def test_divide_after_call_in_condition_is_not_hoisted(self):
+        result, machine = self.run_function("Main.divideAfterCall", [6, 2])
+        self.assertEqual(result, 3)
+        self.assertEqual(machine.output, [0, 1, 2, 3])
+        machine = Machine(self.commands)
+        with self.assertRaises(Halt):
+            machine.run("Main.divideAfterCall", [6, 0])
+        self.assertEqual(machine.output, [0])
+
+    def test_divide_in_body_is_not_hoisted(self):
+        self.assertEqual(self.run_function("Main.divideInBody", [0, 1, 0])[0], 0)
+        result, machine = self.run_function("Main.divideInBody", [3, 7, 2])
+        self.assertEqual(result, 9)
+        self.assertEqual(machine.calls["Math.divide"], 3)
+
+    def test_unusual_calls_are_not_hoisted(self):
+        code = function_code(self.commands, "Main.unusualCalls")
+        self.assertEqual(code[0], ["function", "Main.unusualCalls", "2"])
+        self.assertIn(["push", "None", "None"], code)
+
+    def test_ranges(self):
+        lines = ["label WHILE_START0\n", "push local 0\n", "push argument 0\n", "push argument 1\n",
+                 "add\n", "lt\n", "not\n", "if-goto WHILE_END0\n", "push local 0\n",
+                 "push argument 0\n", "push constant 1\n", "add\n", "neg\n", "add\n",
+                 "pop local 0\n", "goto WHILE_START0\n", "label WHILE_END0\n"]
+        self.assertEqual(find_invariant_ranges(lines, 6), [(2, 5), (9, 13)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Checks that self-recursive tail calls become jumps that run in constant stack space and still
+compute what the recursive calls did.
+'''
+
+import unittest
+from test_if_layout import Machine, compile_class, function_code
+
+SOURCE = '''
+class Main {
+    field int n;
+
+    constructor Main new(int x) {
+        let n = x;
+        return this;
+    }
+
+    method int countOn(int k) {
+        if (k = 0) { return n; }
+        let n = n + 1;
+        return countOn(k - 1);
+    }
+
+    method int alternate(Main other, int k) {
+        if (k = 0) { return n; }
+        return other.alternate(this, k - 1);
+    }
+
+    function int sum(int k, int total) {
+        var int seen;
+        if (k = 0) { return total + seen; }
+        let seen = seen + 1;
+        return Main.sum(k - 1, total + seen);
+    }
+
+    function int twice(int k, int total) {
+        var int doubled;
+        let doubled = k + k;
+        if (k = 0) { return total; }
+        return Main.twice(k - 1, total + doubled);
+    }
+
+    function int count(int k, int total) {
+        var int i;
+        while (i < k) {
+            let i = i + 1;
+            if (i = 3) { return Main.count(k - 1, total + i); }
+        }
+        return total + i;
+    }
+
+    function int runCountOn(int start, int k) {
+        var Main object;
+        let object = Main.new(start);
+        return object.countOn(k);
+    }
+
+    function int runAlternate(int k) {
+        var Main first, second;
+        let first = Main.new(1);
+        let second = Main.new(2);
+        return first.alternate(second, k);
+    }
+}
+'''
+
+
+def resets_local(code, index):
+    return any(code[position:position + 2] == [["push", "constant", "0"], ["pop", "local", str(index)]]
+               for position in range(len(code)))
+
+
+class TailCallTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = compile_class(SOURCE)
+
+    def test_method_call_on_this_is_a_jump(self):
+        self.assertNotIn(["call", "Main.countOn", "2"], function_code(self.commands, "Main.countOn"))
+        machine = Machine(self.commands)
+        self.assertEqual(machine.run("Main.runCountOn", [5, 1000]), 1005)
+        self.assertEqual(machine.calls["Main.countOn"], 1)
+
+    def test_method_call_on_another_object_stays_a_call(self):
+        self.assertIn(["call", "Main.alternate", "3"], function_code(self.commands, "Main.alternate"))
+        for k, expected in [(0, 1), (1, 2), (2, 1), (7, 2)]:
+            with self.subTest(k=k):
+                self.assertEqual(Machine(self.commands).run("Main.runAlternate", [k]), expected)
+
+    def test_local_read_before_assigned_is_reset(self):
+        self.assertTrue(resets_local(function_code(self.commands, "Main.sum"), 0))
+        machine = Machine(self.commands)
+        self.assertEqual(machine.run("Main.sum", [500, 0]), 500)
+        self.assertEqual(machine.max_depth, 1)
+
+    def test_local_assigned_first_is_not_reset(self):
+        code = function_code(self.commands, "Main.twice")
+        self.assertNotIn(["call", "Main.twice", "2"], code)
+        self.assertFalse(resets_local(code, 0))
+        self.assertEqual(Machine(self.commands).run("Main.twice", [10, 0]), 110)
+
+    def test_tail_call_inside_while_loop(self):
+        machine = Machine(self.commands)
+        self.assertEqual(machine.run("Main.count", [5, 0]), 11)
+        self.assertEqual(machine.max_depth, 1)
+        self.assertEqual(Machine(self.commands).run("Main.count", [2, 4]), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()